@@ -10,7 +10,8 @@ def create_first_level_wf(name,
                           fwhm,# = None,
                           thigh_pass,# = None,
                           confounds,
-                          twenty_four=False):
+                          twenty_four=False,
+                          omp_nthreads=1):
     
     import nipype.pipeline.engine as pe 
     from nipype.interfaces import utility, io
@@ -19,7 +20,7 @@ def create_first_level_wf(name,
     from nipype.interfaces import fsl
     from niflow.nipype1.workflows.fmri.fsl.preprocess import create_susan_smooth
     
-    from utils import create_subject_info
+    from utils import create_subject_info, set_thread_budget
     
     first_level_wf = pe.Workflow(name = name)
     
@@ -158,4 +159,7 @@ def create_first_level_wf(name,
     # This is just to have the design matrix used
     first_level_wf.connect(feat, 'design_image', datasink, 'design_image')
 
+    # Explicit thread count for every node, so MultiProc does not oversubscribe
+    set_thread_budget(first_level_wf, omp_nthreads)
+
     return first_level_wf
@@ -0,0 +1,54 @@
+def create_fixed_effects_wf(name,
+                            output_dir,
+                            copes,
+                            varcopes,
+                            omp_nthreads=1):
+    
+    """ 
+    
+    This function creates the workflow that combines the first level 
+    copes and varcopes of the runs of one session into fixed effects maps. 
+    The combination is computed in-process (no second-level FEAT), and the
+    outputs are written with the same layout as a single-run first level.
+    
+    """
+    
+    import nipype.pipeline.engine as pe 
+    from nipype.interfaces import utility, io
+    
+    from utils import combine_runs_fixed_effects, set_thread_budget
+
+    fixed_effects_wf = pe.Workflow(name = name)
+    
+    # Node to collect the inputs as explained above
+    inputNode = pe.Node(utility.IdentityInterface(fields=["copes",
+                                                          "varcopes"]),
+                     name = "inputSource")
+    
+    inputNode.inputs.copes = copes
+    inputNode.inputs.varcopes = varcopes
+    
+    # Node to compute the inverse-variance weighted average across runs
+    combine = pe.Node(name="combine_runs",
+                      interface= utility.Function(input_names=["cope_files",
+                                                               "varcope_files"],
+                                                  output_names = ["copes",
+                                                                  "varcopes",
+                                                                  "ffx_zstats"],
+                                                  function = combine_runs_fixed_effects)
+                      )
+    
+    fixed_effects_wf.connect(inputNode, "copes", combine, "cope_files")
+    fixed_effects_wf.connect(inputNode, "varcopes", combine, "varcope_files")
+    
+    datasink = pe.Node(io.DataSink(base_directory=output_dir), 
+                       name="datasink")
+    
+    fixed_effects_wf.connect([(combine, datasink, [("copes", "copes"),
+                                                   ("varcopes", "varcopes"),
+                                                   ("ffx_zstats", "stats")])
+                              ])
+    
+    set_thread_budget(fixed_effects_wf, omp_nthreads)
+        
+    return fixed_effects_wf
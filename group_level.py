@@ -6,7 +6,8 @@ def create_group_level_wf(name,
                           flame_mode = "flame1",
                           randomise=True,
                           n_perms=1000,
-                          seed = None):
+                          seed = None,
+                          omp_nthreads = 1):
     
     """ 
     
@@ -19,6 +20,8 @@ def create_group_level_wf(name,
     import nipype.pipeline.engine as pe 
     from nipype.interfaces import utility, io
     from nipype.interfaces import fsl
+    
+    from utils import set_thread_budget
 
     group_level_wf = pe.Workflow(name = name)
     
@@ -85,4 +88,7 @@ def create_group_level_wf(name,
                                 ])
     
         
+    # FLAMEO and randomise get the same thread budget as the rest
+    set_thread_budget(group_level_wf, omp_nthreads)
+
     return group_level_wf
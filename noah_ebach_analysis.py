@@ -33,6 +33,9 @@ def get_parser():
                         nargs='*', help='process only particular subjects')
     parser.add_argument('--ncpus', action='store', type=int,
                          help='number of cpus')    
+    parser.add_argument('--omp_nthreads', action='store', type=int,
+                         help='maximum number of threads per process (default: 1\n'
+                              'with --ncpus, not limited otherwise)')
     parser.add_argument('-w', '--work_dir', action='store', type=Path,
                         dest = "work_dir",
                          help='path where intermediate results should be stored')
@@ -40,6 +43,13 @@ def get_parser():
     parser.add_argument('--config_file', action='store', type=Path,
                         dest = "config_file",
                          help='path to config file')
+    parser.add_argument('--atlas_file', action='store', type=Path,
+                        dest = "atlas_file",
+                         help='label atlas used to extract parcel-wise values of\n'
+                              'the first level copes and zstats')
+    parser.add_argument('--parcel_format', action='store', type=str,
+                        choices=['parquet', 'feather'], default='parquet',
+                         help='format of the table with the parcel-wise values')
 
 
     return parser    
@@ -47,6 +57,26 @@ def get_parser():
 
 def main():
     
+    from utils import thread_environ
+    
+    opts = get_parser().parse_args()
+    
+    # Thread budget of each process. This has to be set before numpy/FSL 
+    # start their thread pools, and the MultiProc workers inherit it. 
+    # Without --ncpus or --omp_nthreads the environment is left as it is
+    if opts.omp_nthreads:
+        omp_nthreads = opts.omp_nthreads
+    elif opts.ncpus:
+        omp_nthreads = 1
+    else:
+        omp_nthreads = None
+        
+    if opts.ncpus and omp_nthreads:
+        omp_nthreads = min(omp_nthreads, opts.ncpus)
+    
+    if omp_nthreads:
+        os.environ.update(thread_environ(omp_nthreads))
+    
     from bids.layout import BIDSLayout
     from templateflow.api import get as tpl_get
     
@@ -56,10 +86,13 @@ def main():
     
     #from nilearn import image
     from first_level import create_first_level_wf 
+    from fixed_effects import create_fixed_effects_wf
     from group_level import create_group_level_wf 
+    from parcel_level import create_parcel_level_wf
     from utils import (create_workflow_name, create_output_dir, 
-                        get_contrasts, get_data_info, default_task_config)
-    opts = get_parser().parse_args()
+                        get_contrasts, get_data_info, default_task_config,
+                        screen_motion, is_excluded_path, 
+                        clean_stale_session, write_session_runs)
     
     
     bids_layout = BIDSLayout(opts.bids_dir.absolute().as_posix(), 
@@ -82,6 +115,7 @@ def main():
             
     task_id = opts.task_id
     print("RUNNIN TASK = %s" % task_id)
+    print("THREADS PER PROCESS = %s" % omp_nthreads)
     
     # If subject ids are supplied, do only for those
     if opts.participant_label:
@@ -143,62 +177,256 @@ def main():
     
     first_level_wf = Workflow(name="First-level")
     
-    # this loops add 
+    # Resolve the input files of every subject, session and run
+    subject_inputs = []
     for subject_id in subject_list:
         for session_id in session_list:
-        
-            inputs_files = {}
-            
-            try:
-                for key, query in query_task.items():
-                    args = query.copy()
-                    filelist = bids_layout.get(task=task_id, 
-                                               subject=subject_id, 
-                                               session=session_id, 
-                                               **args)
-                    inputs_files[key] = filelist[0].path
-            except:
-                print("some file no present for subject %s, task %s" % (subject_id, task_id))
-                continue
-    
-            preproc_bold = inputs_files['preproc_bold']
-            brain_mask = inputs_files['brain_mask']
-            confounds_file = inputs_files['confounds_file']
-            events_file = inputs_files['events_file']
-        
-            run_name = create_workflow_name(task_id, 
-                                            subject_id, 
-                                            session_id, 
-                                            None)
-            
-            output_first_dir = create_output_dir(first_level_dir, 
-                                                 task_id, 
-                                                 subject_id, 
-                                                 session_id, 
-                                                 None)
             
-            output_first_dir = output_first_dir.absolute().as_posix()
-            
-            individual_wf = create_first_level_wf(name=run_name,
-                                                  output_dir=output_first_dir,
-                                                  preproc_bold=preproc_bold,
-                                                  brain_mask=brain_mask,
-                                                  events_file=events_file,
-                                                  confounds_file=confounds_file,
-                                                  contrasts=contrasts,
-                                                  repetition_time=repetition_time,
-                                                  **config_first)
-        
-            if os.path.exists(output_first_dir) is False:
-                print("adding first-level %s " % run_name)
-                first_level_wf.add_nodes([individual_wf])
-    
-    # Run this
+            run_list = bids_layout.get(return_type='id', 
+                                       target='run',
+                                       task=task_id, 
+                                       subject=subject_id, 
+                                       session=session_id, 
+                                       **query_task['preproc_bold'])
+            if not run_list:
+                run_list = [None]
+        
+            for run in run_list:
+                
+                inputs_files = {}
+                run_query = {} if run is None else {'run': run}
+                
+                try:
+                    for key, query in query_task.items():
+                        args = query.copy()
+                        filelist = bids_layout.get(task=task_id, 
+                                                   subject=subject_id, 
+                                                   session=session_id, 
+                                                   **run_query,
+                                                   **args)
+                        inputs_files[key] = filelist[0].path
+                except:
+                    print("some file no present for subject %s, task %s, run %s" % (subject_id, 
+                                                                                   task_id, 
+                                                                                   run))
+                    continue
+                
+                run_id = None if run is None else str(run)
+                subject_inputs.append((subject_id, session_id, run_id, inputs_files))
+    
+    # Screen the motion of every run before building the graph, so that
+    # high-motion runs are neither fitted nor taken to the group level
+    excluded_runs = set()
+    config_screening = config_task.get("config_screening")
+    if config_screening:
+        exclusion_reasons = screen_motion([inputs_files['confounds_file'] \
+                                           for _, _, _, inputs_files in subject_inputs],
+                                          n_procs=opts.ncpus,
+                                          start_ix=config_first["start_ix"],
+                                          **config_screening)
+        
+        with open(log_dir.joinpath("motion_exclusions.log"), "w") as f:
+            for (subject_id, session_id, run_id, _), reason in zip(subject_inputs, 
+                                                                   exclusion_reasons):
+                if reason is None:
+                    continue
+                excluded_runs.add((subject_id, session_id, run_id))
+                excluded_name = "sub-%s ses-%s" % (subject_id, session_id)
+                if run_id is not None:
+                    excluded_name += " run-%s" % run_id
+                print("excluding %s: %s" % (excluded_name, reason))
+                f.write(excluded_name + " = ")
+                f.write(reason + "\n")
+    
+    subject_inputs = [(subject_id, session_id, run_id, inputs_files) \
+                      for subject_id, session_id, run_id, inputs_files in subject_inputs \
+                      if (subject_id, session_id, run_id) not in excluded_runs]
+    
+    # Runs left for each subject/session. Sessions with all their runs 
+    # excluded are left out of the rest of the analysis
+    session_runs = {}
+    for subject_id, session_id, run_id, _ in subject_inputs:
+        session_runs.setdefault((subject_id, session_id), []).append(run_id)
+        
+    excluded = set((subject_id, session_id) for subject_id, session_id, _ in excluded_runs) \
+                - set(session_runs)
+    
+    # Session-level maps computed from another set of runs (e.g. a run-1-only 
+    # fit of a multi-run session, or a combination including a run that is
+    # now excluded) are removed, so that they are computed again. The new
+    # maps have new timestamps, so the cached parcel extraction reruns too
+    for (subject_id, session_id), run_ids in session_runs.items():
+        session_first_dir = create_output_dir(first_level_dir, 
+                                              task_id, 
+                                              subject_id, 
+                                              session_id, 
+                                              None)
+        if clean_stale_session(session_first_dir, run_ids):
+            print("removed stale first-level maps of subject %s, session %s" % (subject_id, 
+                                                                               session_id))
+    
+    # this loops add 
+    for subject_id, session_id, run_id, inputs_files in subject_inputs:
+    
+        preproc_bold = inputs_files['preproc_bold']
+        brain_mask = inputs_files['brain_mask']
+        confounds_file = inputs_files['confounds_file']
+        events_file = inputs_files['events_file']
+        
+        # Single-run sessions are written as before, without a run folder
+        if len(session_runs[(subject_id, session_id)]) == 1:
+            run_id = None
+    
+        run_name = create_workflow_name(task_id, 
+                                        subject_id, 
+                                        session_id, 
+                                        run_id)
+        
+        output_first_dir = create_output_dir(first_level_dir, 
+                                             task_id, 
+                                             subject_id, 
+                                             session_id, 
+                                             run_id)
+        
+        output_first_dir = output_first_dir.absolute().as_posix()
+        
+        individual_wf = create_first_level_wf(name=run_name,
+                                              output_dir=output_first_dir,
+                                              preproc_bold=preproc_bold,
+                                              brain_mask=brain_mask,
+                                              events_file=events_file,
+                                              confounds_file=confounds_file,
+                                              contrasts=contrasts,
+                                              repetition_time=repetition_time,
+                                              omp_nthreads=omp_nthreads,
+                                              **config_first)
+    
+        if os.path.exists(opj(output_first_dir, "copes")) is False:
+            print("adding first-level %s " % run_name)
+            first_level_wf.add_nodes([individual_wf])
+    
+    # Run this (runs of the same session are fitted in parallel too)
     first_level_wf.base_dir = work_dir
     first_level_wf.run(**run_config)
     
+    # Combine the runs of each multi-run session into fixed effects maps, 
+    # which take the place of the session's first level for what follows
+    fixed_effects_wf = Workflow(name="Fixed-effects")
+    
+    for (subject_id, session_id), run_ids in session_runs.items():
+        
+        if len(run_ids) == 1:
+            continue
+        
+        session_first_dir = create_output_dir(first_level_dir, 
+                                              task_id, 
+                                              subject_id, 
+                                              session_id, 
+                                              None)
+        
+        run_first_dirs = [create_output_dir(first_level_dir, 
+                                            task_id, 
+                                            subject_id, 
+                                            session_id, 
+                                            run_id) for run_id in run_ids]
+        
+        copes = [[run_dir.joinpath("copes", 
+                                   "cope%d.nii.gz" % (ii+1)).absolute().as_posix() \
+                  for ii in range(len(contrasts))] for run_dir in run_first_dirs]
+        varcopes = [[run_dir.joinpath("varcopes", 
+                                      "varcope%d.nii.gz" % (ii+1)).absolute().as_posix() \
+                     for ii in range(len(contrasts))] for run_dir in run_first_dirs]
+        
+        ffx_name = create_workflow_name(task_id, 
+                                        subject_id, 
+                                        session_id, 
+                                        None) + "_ffx"
+        
+        session_ffx_wf = create_fixed_effects_wf(name=ffx_name,
+                                                 output_dir=session_first_dir.absolute().as_posix(),
+                                                 copes=copes,
+                                                 varcopes=varcopes,
+                                                 omp_nthreads=omp_nthreads)
+        
+        if session_first_dir.joinpath("copes").exists() is False:
+            print("adding fixed-effects %s " % ffx_name)
+            fixed_effects_wf.add_nodes([session_ffx_wf])
+    
+    fixed_effects_wf.base_dir = work_dir
+    fixed_effects_wf.run(**run_config)
+    
+    # Keep track of the runs behind each session-level map
+    for (subject_id, session_id), run_ids in session_runs.items():
+        session_first_dir = create_output_dir(first_level_dir, 
+                                              task_id, 
+                                              subject_id, 
+                                              session_id, 
+                                              None)
+        if session_first_dir.joinpath("copes").exists():
+            write_session_runs(session_first_dir, run_ids)
+    
     print("first level analysis done!")
     
+    ################### PARCEL EXTRACTION PART##################
+    if opts.atlas_file:
+        
+        n_contrasts = len(contrasts)
+        parcel_inputs = dict(subject_ids=[], session_ids=[], copes=[], zstats=[], 
+                             zstat_names=[])
+        
+        for subject_id in subject_list:
+            for session_id in session_list:
+                
+                if (subject_id, session_id) in excluded:
+                    continue
+                
+                subject_first_dir = create_output_dir(first_level_dir, 
+                                                      task_id, 
+                                                      subject_id, 
+                                                      session_id, 
+                                                      None)
+                
+                # Sessions combined across runs have fixed effects zstats
+                if len(session_runs.get((subject_id, session_id), [None])) > 1:
+                    zstat_name = "ffx_zstat"
+                else:
+                    zstat_name = "zstat"
+                
+                copes = [subject_first_dir.joinpath("copes", 
+                                                    "cope%d.nii.gz" % (ii+1)).absolute().as_posix() \
+                         for ii in range(n_contrasts)]
+                zstats = [subject_first_dir.joinpath("stats", 
+                                                     "%s%d.nii.gz" % (zstat_name, ii+1)).absolute().as_posix() \
+                          for ii in range(n_contrasts)]
+                
+                if all(os.path.exists(ff) for ff in copes + zstats) is False:
+                    print("no first-level maps for subject %s, session %s" % (subject_id, session_id))
+                    continue
+                
+                parcel_inputs["subject_ids"].append(subject_id)
+                parcel_inputs["session_ids"].append(session_id)
+                parcel_inputs["copes"].append(copes)
+                parcel_inputs["zstats"].append(zstats)
+                parcel_inputs["zstat_names"].append(zstat_name)
+        
+        if not parcel_inputs["subject_ids"]:
+            print("no first-level maps to extract parcel values from")
+        else:
+            parcel_level_dir = output_dir.joinpath("parcel_level/task-%s" % task_id)
+            parcel_level_dir.mkdir(parents=True, exist_ok=True)
+        
+            parcel_level_wf = create_parcel_level_wf(name="Parcel-level",
+                                                     output_dir=parcel_level_dir.absolute().as_posix(),
+                                                     atlas_file=opts.atlas_file.absolute().as_posix(),
+                                                     table_format=opts.parcel_format,
+                                                     omp_nthreads=omp_nthreads,
+                                                     **parcel_inputs)
+        
+            parcel_level_wf.base_dir = work_dir
+            parcel_level_wf.run(**run_config)
+        
+            print("parcel extraction done!")
+    
     ################### GROUP LEVEL PART##################
     if opts.analysis_level == "group":
         config_group = config_task["config_group"]
@@ -242,6 +470,12 @@ def main():
                             "*", "ses-01", "varcopes",
                             "varcope" + str(ii+1) + ".nii.gz"))
             
+            # Leave out the subjects/sessions excluded by the motion screening
+            copes = [cope for cope in copes \
+                     if not is_excluded_path(cope, excluded)]
+            varcopes = [varcope for varcope in varcopes \
+                        if not is_excluded_path(varcope, excluded)]
+            
             group_level_dir = output_dir.joinpath("group_level/task-%s/cond_%d" % (task_id, 
                                                                                    (ii+1)))
             group_level_dir.mkdir(parents=True, exist_ok=True)
@@ -254,6 +488,7 @@ def main():
                                                   copes,
                                                   varcopes, 
                                                   group_mask_file, 
+                                                  omp_nthreads=omp_nthreads,
                                                   **config_group)
             
             group_level_wf.add_nodes([cond_group_wf])
@@ -0,0 +1,88 @@
+def create_parcel_level_wf(name,
+                           output_dir,
+                           subject_ids,
+                           session_ids,
+                           copes,
+                           zstats,
+                           zstat_names,
+                           atlas_file,
+                           table_format="parquet",
+                           omp_nthreads=1):
+    
+    """ 
+    
+    This function creates the workflow for extracting the parcel-wise values 
+    of the first level copes and zstats. Subjects are processed in parallel 
+    (one map node iteration each, which nipype also caches by the hash of its 
+    inputs) and the results are written as a single subjects x contrasts x 
+    parcels table. zstat_names labels the zstats of each subject in the 
+    table (zstat, or ffx_zstat for sessions combined across runs).
+    
+    """
+    
+    import nipype.pipeline.engine as pe 
+    from nipype.interfaces import utility, io
+    
+    from utils import extract_parcel_values, write_parcel_table, set_thread_budget
+
+    parcel_level_wf = pe.Workflow(name = name)
+    
+    # Node to collect the inputs as explained above
+    inputNode = pe.Node(utility.IdentityInterface(fields=["subject_ids",
+                                                          "session_ids",
+                                                          "copes",
+                                                          "zstats",
+                                                          "zstat_names",
+                                                          "atlas_file"]),
+                     name = "inputSource")
+    
+    inputNode.inputs.subject_ids = subject_ids
+    inputNode.inputs.session_ids = session_ids
+    inputNode.inputs.copes = copes
+    inputNode.inputs.zstats = zstats
+    inputNode.inputs.zstat_names = zstat_names
+    inputNode.inputs.atlas_file = atlas_file
+    
+    # Node to reduce the maps of each subject onto the atlas parcels
+    extract = pe.MapNode(name="extract_parcels",
+                         interface= utility.Function(input_names=["subject_id",
+                                                                  "session_id",
+                                                                  "cope_files",
+                                                                  "zstat_files",
+                                                                  "atlas_file",
+                                                                  "zstat_name"],
+                                                     output_names = ["parcel_file"],
+                                                     function = extract_parcel_values),
+                         iterfield = ["subject_id", "session_id", 
+                                      "cope_files", "zstat_files", "zstat_name"]
+                         )
+    
+    parcel_level_wf.connect([(inputNode, extract, [("subject_ids", "subject_id"),
+                                                   ("session_ids", "session_id"),
+                                                   ("copes", "cope_files"),
+                                                   ("zstats", "zstat_files"),
+                                                   ("zstat_names", "zstat_name"),
+                                                   ("atlas_file", "atlas_file")])
+                             ])
+    
+    # Node to gather all subjects in one table
+    write_table = pe.Node(name="write_table",
+                          interface= utility.Function(input_names=["parcel_files",
+                                                                   "out_file"],
+                                                      output_names = ["out_file"],
+                                                      function = write_parcel_table)
+                          )
+    
+    write_table.inputs.out_file = "parcel_values.%s" % table_format
+    
+    parcel_level_wf.connect(extract, "parcel_file", write_table, "parcel_files")
+    
+    datasink = pe.Node(io.DataSink(base_directory=output_dir), 
+                       name="datasink")
+    
+    parcel_level_wf.connect(write_table, "out_file", datasink, "@parcel_table")
+        
+    # Give each extraction the thread budget
+    set_thread_budget(parcel_level_wf, omp_nthreads)
+
+    return parcel_level_wf
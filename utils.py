@@ -70,6 +70,241 @@ def create_subject_info(bids_evs_file,
     return info
 
 
+def screen_confounds_file(confounds_file,
+                          mean_fd_max=None,
+                          fd_cutoff=None,
+                          max_perc_fd=None,
+                          dvars_cutoff=None,
+                          max_perc_dvars=None,
+                          start_ix=0):
+    """
+    
+    Function that checks the motion of a run from its confounds file. Only
+    the framewise_displacement (and dvars, if thresholded) columns are read. 
+    Returns the reason for excluding the run, or None if it passes.
+    
+    """
+    
+    import pandas as pd
+    
+    columns = ["framewise_displacement"]
+    if dvars_cutoff is not None and max_perc_dvars is not None:
+        columns.append("dvars")
+        
+    confounds_df = pd.read_csv(confounds_file, sep="\t", na_values="n/a", 
+                               usecols=columns)
+    confounds_df = confounds_df.iloc[start_ix:]
+    
+    fd = confounds_df["framewise_displacement"].dropna()
+    
+    if mean_fd_max is not None and fd.mean() > mean_fd_max:
+        return "mean FD = %.3f > %.3f" % (fd.mean(), mean_fd_max)
+    
+    if fd_cutoff is not None and max_perc_fd is not None:
+        perc_fd = 100*(fd > fd_cutoff).mean()
+        if perc_fd > max_perc_fd:
+            return "%.1f%% of volumes with FD > %.3f (max %.1f%%)" % (perc_fd, 
+                                                                    fd_cutoff, 
+                                                                    max_perc_fd)
+        
+    if "dvars" in columns:
+        dvars = confounds_df["dvars"].dropna()
+        perc_dvars = 100*(dvars > dvars_cutoff).mean()
+        if perc_dvars > max_perc_dvars:
+            return "%.1f%% of volumes with DVARS > %.3f (max %.1f%%)" % (perc_dvars, 
+                                                                       dvars_cutoff, 
+                                                                       max_perc_dvars)
+    return None
+
+
+def screen_motion(confounds_files, n_procs=None, **thresholds):
+    """
+    
+    Function that screens a list of confounds files in parallel (see 
+    screen_confounds_file). Returns the list of exclusion reasons, in the 
+    same order as confounds_files.
+    
+    """
+    
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+    
+    screen = partial(screen_confounds_file, **thresholds)
+    
+    if not n_procs:
+        return [screen(ff) for ff in confounds_files]
+    
+    with ProcessPoolExecutor(max_workers=n_procs) as executor:
+        return list(executor.map(screen, confounds_files))
+    
+
+def is_excluded_path(filepath, excluded):
+    """Check whether a first level map belongs to an excluded subject/session"""
+    
+    from pathlib import Path
+    
+    parts = Path(filepath).parts
+    
+    return any(("sub-" + subject_id) in parts and ("ses-" + session_id) in parts \
+               for subject_id, session_id in excluded)
+
+
+def combine_runs_fixed_effects(cope_files, varcope_files):
+    """
+    
+    Function that combines the first level maps of several runs into fixed
+    effects maps, using the inverse-variance weighted average of the copes. 
+    cope_files and varcope_files are lists (one element per run) of lists 
+    (one file per contrast). Voxels with no variance in a run are left out 
+    of that run's contribution. The ffx_zstats are cope/sqrt(varcope), i.e. 
+    assuming enough degrees of freedom for the normal approximation, so they
+    are named apart from the FILMGLS zstats.
+    
+    """
+    
+    import os
+    import numpy as np
+    import nibabel as nib
+    
+    out_copes, out_varcopes, out_ffx_zstats = [], [], []
+    
+    for ii, (run_copes, run_varcopes) in enumerate(zip(zip(*cope_files), 
+                                                       zip(*varcope_files))):
+        
+        ref_img = nib.load(run_copes[0])
+        
+        # runs x voxels arrays, so that all runs are combined at once
+        copes = np.stack([np.asanyarray(nib.load(ff).dataobj) for ff in run_copes])
+        varcopes = np.stack([np.asanyarray(nib.load(ff).dataobj) for ff in run_varcopes])
+        
+        weights = np.zeros(varcopes.shape)
+        np.divide(1., varcopes, out=weights, where=varcopes > 0)
+        sum_weights = weights.sum(axis=0)
+        in_mask = sum_weights > 0
+        
+        ffx_varcope = np.zeros(sum_weights.shape)
+        np.divide(1., sum_weights, out=ffx_varcope, where=in_mask)
+        ffx_cope = (weights*copes).sum(axis=0)*ffx_varcope
+        ffx_zstat = np.zeros(sum_weights.shape)
+        np.divide(ffx_cope, np.sqrt(ffx_varcope), out=ffx_zstat, where=in_mask)
+        
+        for data, prefix, out_list in [(ffx_cope, "cope", out_copes),
+                                       (ffx_varcope, "varcope", out_varcopes),
+                                       (ffx_zstat, "ffx_zstat", out_ffx_zstats)]:
+            out_file = os.path.abspath("%s%d.nii.gz" % (prefix, ii + 1))
+            out_img = nib.Nifti1Image(data.astype(np.float32), 
+                                      ref_img.affine, 
+                                      ref_img.header)
+            out_img.set_data_dtype(np.float32)
+            out_img.to_filename(out_file)
+            out_list.append(out_file)
+    
+    return out_copes, out_varcopes, out_ffx_zstats
+
+
+def clean_stale_session(session_dir, run_ids):
+    """
+    
+    Function that checks that the session-level first level maps were 
+    computed from the runs in run_ids (a single-run fit or the fixed effects 
+    combination), using the list of runs stored next to them. Otherwise 
+    the maps are removed, so that they are computed again. Maps without 
+    that list (made before it was stored) are taken as a single-run fit only
+    if the session has no run folders. Returns True if maps were removed.
+    
+    """
+    
+    import json
+    import shutil
+    from pathlib import Path
+    
+    session_dir = Path(session_dir)
+    runs_file = session_dir.joinpath("session_runs.json")
+    
+    if session_dir.joinpath("copes").exists() is False:
+        return False
+    
+    if runs_file.exists():
+        with open(runs_file, "r") as f:
+            done_runs = json.load(f)
+    elif len(run_ids) == 1 and not list(session_dir.glob("run-*")):
+        done_runs = list(run_ids)
+    else:
+        done_runs = None
+        
+    if done_runs == list(run_ids):
+        return False
+    
+    for folder in ["betas", "stats", "copes", "varcopes", "design_image"]:
+        shutil.rmtree(session_dir.joinpath(folder), ignore_errors=True)
+    if runs_file.exists():
+        runs_file.unlink()
+    
+    return True
+
+
+def write_session_runs(session_dir, run_ids):
+    """Store the runs the session-level first level maps were computed from"""
+    
+    import json
+    from pathlib import Path
+    
+    with open(Path(session_dir).joinpath("session_runs.json"), "w") as f:
+        json.dump(list(run_ids), f)
+
+
+def thread_environ(n_threads):
+    """
+    
+    Function that gives the environment variables that cap the size of the 
+    OpenMP/BLAS thread pools (FSL tools built with OpenMP also read 
+    OMP_NUM_THREADS) to n_threads.
+    
+    """
+    
+    thread_vars = ["OMP_NUM_THREADS", 
+                   "MKL_NUM_THREADS", 
+                   "OPENBLAS_NUM_THREADS",
+                   "NUMEXPR_NUM_THREADS",
+                   "VECLIB_MAXIMUM_THREADS"]
+    
+    return {var: str(n_threads) for var in thread_vars}
+
+
+def set_thread_budget(workflow, n_threads):
+    """
+    
+    Function that gives the compute nodes of a workflow (command line 
+    interfaces and python functions, including those of nested workflows) 
+    an explicit thread count. The MultiProc scheduler reserves n_threads 
+    cpus for each of them and command line interfaces get their thread 
+    pools capped through their environment. Bookkeeping nodes (identity, 
+    select, datasink) keep a single cpu. If n_threads is None, the 
+    workflow is left untouched.
+    
+    """
+    
+    from nipype.interfaces.base import CommandLine
+    from nipype.interfaces.utility import Function
+    
+    if n_threads is None:
+        return workflow
+    
+    for node_name in workflow.list_node_names():
+        node = workflow.get_node(node_name)
+        
+        if not isinstance(node.interface, (CommandLine, Function)):
+            continue
+        
+        node.n_procs = n_threads
+        
+        if isinstance(node.interface, CommandLine):
+            node.inputs.environ = dict(node.inputs.environ, 
+                                       **thread_environ(n_threads))
+    
+    return workflow
+    
+
 def create_workflow_name(task_id, subject_id, session_id, run_id):
     
     name = 'task_' + task_id + '_sub_'  + subject_id 
@@ -205,6 +440,12 @@ def default_task_config(task_id):
                                   "twenty_four" : False,
                                   "confounds" : confounds}
         
+    # Runs above any of these thresholds are left out of the analysis
+    config["config_screening"] = {"mean_fd_max" : 0.5,
+                                  "fd_cutoff" : 0.5,
+                                  "max_perc_fd" : 20.0,
+                                  "dvars_cutoff" : None,
+                                  "max_perc_dvars" : None}
         
     config["config_group"] = {"flame_mode" : "flame1",
                                "randomise" : True,
@@ -215,3 +456,114 @@ def default_task_config(task_id):
 
 
 
+
+
+def extract_parcel_values(subject_id,
+                          session_id,
+                          cope_files,
+                          zstat_files,
+                          atlas_file,
+                          zstat_name="zstat"):
+    """
+    
+    Function that reduces every cope/zstat map of one subject (and session)
+    onto the parcels of a label atlas. Each map is loaded only once and all 
+    the parcels are reduced together using label-indexed sums, so there is
+    no loop over ROIs. The copes (FILMGLS and fixed effects ones) are 0 
+    outside the subject's brain mask, so only voxels where some cope is 
+    non-zero are reduced, and non-finite voxels are left out of each map; 
+    n_voxels counts the voxels actually reduced. The long-format table, with one row per (contrast, 
+    stat, parcel) and the zstat maps labelled zstat_name (e.g. ffx_zstat 
+    for fixed effects sessions), is written to a parquet file in the 
+    working directory, whose path is returned (so that the next node hashes
+    a file rather than the in-memory data frame).
+    
+    """
+    
+    import os
+    import numpy as np
+    import pandas as pd
+    import nibabel as nib
+    
+    atlas_img = nib.load(atlas_file)
+    atlas = np.rint(np.asanyarray(atlas_img.dataobj)).astype(int).ravel()
+    
+    # Keep only labelled voxels and map labels to a compact 0..n-1 index
+    in_atlas = atlas > 0
+    labels, label_ix = np.unique(atlas[in_atlas], return_inverse=True)
+    n_labels = len(labels)
+    
+    stat_files = [("cope", ii + 1, cope_file) for ii, cope_file in enumerate(cope_files)]
+    stat_files += [(zstat_name, ii + 1, zstat_file) for ii, zstat_file in enumerate(zstat_files)]
+    
+    data = np.empty((len(stat_files), label_ix.size))
+    for ii, (_, _, stat_file) in enumerate(stat_files):
+        stat_img = nib.load(stat_file)
+        if stat_img.shape[:3] != atlas_img.shape[:3]:
+            raise ValueError("%s and the atlas %s do not have the same dimensions" % (stat_file, 
+                                                                                      atlas_file))
+        if not np.allclose(stat_img.affine, atlas_img.affine):
+            raise ValueError("%s and the atlas %s are not in the same space" % (stat_file, 
+                                                                                atlas_file))
+        data[ii] = np.asanyarray(stat_img.dataobj).ravel()[in_atlas]
+    
+    # Voxels outside the subject's brain mask (0 in every cope) are left 
+    # out, as well as the non-finite voxels of each map
+    finite = np.isfinite(data)
+    in_brain = ((data[:len(cope_files)] != 0) & finite[:len(cope_files)]).any(axis=0)
+    valid = finite & in_brain[None, :]
+    
+    # Offset the parcel index of each map, so that one bincount reduces
+    # all maps and parcels at once
+    flat_ix = (label_ix[None, :] + n_labels*np.arange(len(stat_files))[:, None])[valid]
+    n_bins = n_labels*len(stat_files)
+    
+    sums = np.bincount(flat_ix, weights=data[valid], minlength=n_bins)
+    counts = np.bincount(flat_ix, minlength=n_bins)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.where(counts > 0, sums/counts, np.nan)
+    
+    stat_names, contrast_ids, _ = zip(*stat_files)
+    
+    parcel_df = pd.DataFrame({"subject": subject_id,
+                              "session": session_id,
+                              "stat": np.repeat(stat_names, n_labels),
+                              "contrast": np.repeat(contrast_ids, n_labels),
+                              "label": np.tile(labels, len(stat_files)),
+                              "n_voxels": counts,
+                              "sum": sums,
+                              "mean": means})
+    
+    out_name = "parcel_values_sub-%s" % subject_id
+    if session_id is not None:
+        out_name += "_ses-%s" % session_id
+    out_file = os.path.abspath(out_name + ".parquet")
+    parcel_df.to_parquet(out_file, index=False)
+    
+    return out_file
+
+
+def write_parcel_table(parcel_files, out_file):
+    """
+    
+    Function that concatenates the per-subject parcel values (the parquet 
+    files written by extract_parcel_values) and writes them as a columnar table (parquet or feather, depending on the 
+    extension of out_file).
+    
+    """
+    
+    import os
+    import pandas as pd
+    
+    out_file = os.path.abspath(out_file)
+    parcel_df = pd.concat([pd.read_parquet(ff) for ff in parcel_files], 
+                          ignore_index=True)
+    
+    if out_file.endswith(".parquet"):
+        parcel_df.to_parquet(out_file, index=False)
+    elif out_file.endswith(".feather"):
+        parcel_df.to_feather(out_file)
+    else:
+        raise ValueError("Table format of %s not understood, use parquet or feather" % out_file)
+    
+    return out_file